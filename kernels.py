@@ -0,0 +1,162 @@
+"""Numba kernels used by the rule engine and the renderer.
+
+Every kernel is compiled with cache=True so the compiled artifacts are
+stored next to this module and reused by later runs instead of paying
+the JIT compilation cost on every start.
+"""
+
+import numpy as np
+from numba import njit
+from typing import Tuple
+
+
+@njit(cache=True, fastmath=True)
+def point_in_rois(
+    px: float,
+    py: float,
+    xs: np.ndarray,
+    ys: np.ndarray,
+    lens: np.ndarray,
+    bounds: np.ndarray,
+) -> int:
+    """Crossing-number (ray cast) test of point (px, py) against every roi.
+
+    xs and ys hold the closed ring of each roi row-wise (padded with NaN),
+    lens holds the number of edges of each roi and bounds holds the
+    (minx, miny, maxx, maxy) bounding box of each roi. Returns the index
+    of the first roi containing the point else -1.
+    """
+    for i in range(xs.shape[0]):
+        # points outside the bounding box can never be inside the roi
+        if (
+            px < bounds[i, 0]
+            or px > bounds[i, 2]
+            or py < bounds[i, 1]
+            or py > bounds[i, 3]
+        ):
+            continue
+
+        inside = False
+        for j in range(lens[i]):
+            if (ys[i, j] > py) != (ys[i, j + 1] > py) and px < (
+                xs[i, j + 1] - xs[i, j]
+            ) * (py - ys[i, j]) / (ys[i, j + 1] - ys[i, j]) + xs[i, j]:
+                inside = not inside
+        if inside:
+            return i
+    return -1
+
+
+@njit(cache=True)
+def batch_point_in_rois(
+    cx: np.ndarray,
+    cy: np.ndarray,
+    xs: np.ndarray,
+    ys: np.ndarray,
+    lens: np.ndarray,
+    bounds: np.ndarray,
+) -> np.ndarray:
+    """Runs point_in_rois for every centroid of a frame in a single pass"""
+    result = np.empty(cx.shape[0], dtype=np.int32)
+    for k in range(cx.shape[0]):
+        result[k] = point_in_rois(cx[k], cy[k], xs, ys, lens, bounds)
+    return result
+
+
+@njit(cache=True)
+def scale_bboxes(
+    lefts: np.ndarray,
+    tops: np.ndarray,
+    widths: np.ndarray,
+    heights: np.ndarray,
+    frame_width: float,
+    frame_height: float,
+    cx: np.ndarray,
+    cy: np.ndarray,
+    boxes: np.ndarray,
+) -> None:
+    """Converts fractional bboxes to actual centroids and (truncated) corners"""
+    for k in range(lefts.shape[0]):
+        x0 = lefts[k] * frame_width
+        y0 = tops[k] * frame_height
+        x1 = (lefts[k] + widths[k]) * frame_width
+        y1 = (tops[k] + heights[k]) * frame_height
+        cx[k] = (lefts[k] + widths[k] * 0.5) * frame_width
+        cy[k] = (tops[k] + heights[k] * 0.5) * frame_height
+        boxes[k, 0] = int(x0)
+        boxes[k, 1] = int(y0)
+        boxes[k, 2] = int(x1)
+        boxes[k, 3] = int(y1)
+
+
+@njit(cache=True)
+def clear_image(img: np.ndarray, x0: int, y0: int, x1: int, y1: int) -> None:
+    """Zeroes the [x0, x1) x [y0, y1) region of the provided image (np.array)"""
+    # a slice assignment clears each row with a single memset
+    img[max(y0, 0) : max(y1, 0), max(x0, 0) : max(x1, 0)] = 0
+
+
+@njit(cache=True)
+def draw_line(
+    img: np.ndarray, x0: int, y0: int, x1: int, y1: int, color: Tuple[int, int, int]
+) -> None:
+    """Draws a line on the provided image (np.array) using Bresenham.
+
+    Every point is stamped 1px on each side like cv2.polylines does for a
+    thickness of 2, so lines on the image edges are still 2px wide.
+    """
+    dx = abs(x1 - x0)
+    dy = -abs(y1 - y0)
+    sx = 1 if x0 < x1 else -1
+    sy = 1 if y0 < y1 else -1
+    err = dx + dy
+    while True:
+        # 3x3 stamp centered on the point, independent of the direction
+        for y in range(y0 - 1, y0 + 2):
+            for x in range(x0 - 1, x0 + 2):
+                if 0 <= y < img.shape[0] and 0 <= x < img.shape[1]:
+                    for c in range(3):
+                        img[y, x, c] = color[c]
+        if x0 == x1 and y0 == y1:
+            break
+        e2 = 2 * err
+        if e2 >= dy:
+            err += dy
+            x0 += sx
+        if e2 <= dx:
+            err += dx
+            y0 += sy
+
+
+@njit(cache=True)
+def draw_bbox_edges(
+    img: np.ndarray, x0: int, y0: int, x1: int, y1: int, color: Tuple[int, int, int]
+) -> None:
+    """Draws the 4 edges of an axis aligned bbox on the provided image (np.array)"""
+    draw_line(img, x0, y0, x1, y0, color)
+    draw_line(img, x1, y0, x1, y1, color)
+    draw_line(img, x1, y1, x0, y1, color)
+    draw_line(img, x0, y1, x0, y0, color)
+
+
+@njit(cache=True)
+def draw_polygon(
+    img: np.ndarray, vertices: np.ndarray, color: Tuple[int, int, int]
+) -> None:
+    """Draws a closed polygon on the provided image (np.array)"""
+    n = vertices.shape[0]
+    for i in range(n):
+        j = (i + 1) % n
+        draw_line(
+            img, vertices[i, 0], vertices[i, 1], vertices[j, 0], vertices[j, 1], color
+        )
+
+
+@njit(cache=True)
+def draw_dot(img: np.ndarray, x: int, y: int, color: Tuple[int, int, int]) -> None:
+    """Draws a 9 pixel dot centered at (x, y) on the provided image (np.array)"""
+    for py in range(y - 1, y + 2):
+        for px in range(x - 1, x + 2):
+            if 0 <= py < img.shape[0] and 0 <= px < img.shape[1]:
+                for c in range(3):
+                    img[py, px, c] = color[c]
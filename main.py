@@ -1,24 +1,53 @@
 import cv2
-import json
+import logging
 import os
+import queue
+import threading
 import numpy as np
+import orjson
+import shapely
 from shapely.geometry import Polygon
-from typing import List, Dict, Any, Optional, Set, Tuple
+from typing import List, Dict, Any, Iterable, Optional, Tuple
 from dotenv import load_dotenv
 
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 
+from kernels import (
+    batch_point_in_rois,
+    clear_image,
+    draw_bbox_edges,
+    draw_dot,
+    draw_polygon,
+    scale_bboxes,
+)
+
+# load environment variables once for every RuleEngine instance
+load_dotenv()
+
+# slack client shared by every RuleEngine instance. if token is not present
+# _SLACK_CLIENT will stay None and should_notify will always return False
+_SLACK_CLIENT: Optional[WebClient] = (
+    WebClient(token=os.environ["SLACK_TOKEN"]) if os.getenv("SLACK_TOKEN") else None
+)
+_SLACK_CHANNEL: Optional[str] = os.getenv("SLACK_CHANNEL")
+
+logger = logging.getLogger(__name__)
+
 
 class RuleEngine:
     """RuleEngine class acts as a base for rule implementations"""
 
-    # sets object class to True if it is in
-    # that region of interest (roi) else sets it to False
-    _objects_in_rois: List[Dict[str, bool]] = list()
+    # (rois, classes) array that sets the object class column to 1 if it
+    # is in that region of interest (roi) else sets it to 0
+    _objects_in_rois: np.ndarray
 
     # stores region of interest in the form of shapely Polygon for calculations
-    _rois: List[Polygon] = list()
+    _rois: List[Polygon]
+
+    # maps object class to its column in _objects_in_rois, also used
+    # as the class id in the per frame class arrays
+    _class_ids: Dict[str, int] = {"car": 0, "person": 1, "truck": 2}
 
     # the difference between current positive frame and last positive frame
     # (current_positive_frame - last_positive_frame) should be greater than
@@ -32,74 +61,68 @@ class RuleEngine:
     _maximum_allowed_diff: int = 1
     _last_positive_frame: int = 0
 
-    # slack client that is used for notification. if token is not present
-    # __slack_client will stay None and self.should_notify will always return False
-    __slack_client: Optional[WebClient] = None
+    # slack client that is used for notification
+    __slack_client: Optional[WebClient]
     __slack_channel: str
 
     def __init__(self, rois: List[List[Tuple[int, int]]]) -> None:
-        for roi in rois:
-            self._rois.append(Polygon(roi))
-            self._objects_in_rois.append(
-                {"car": False, "person": False, "truck": False}
+        # bulk construction is only available from shapely 2.0
+        if hasattr(shapely, "polygons") and len(rois) > 0:
+            rings = shapely.linearrings(
+                np.concatenate([np.asarray(roi, dtype=np.float64) for roi in rois]),
+                indices=np.repeat(np.arange(len(rois)), [len(roi) for roi in rois]),
             )
+            self._rois = list(shapely.polygons(rings))
+        else:
+            self._rois = [Polygon(roi) for roi in rois]
+        self._objects_in_rois = np.zeros(
+            (len(self._rois), len(self._class_ids)), dtype=np.uint8
+        )
 
-        # load environment variables
-        load_dotenv()
-        if os.getenv("SLACK_TOKEN"):
-            self.__slack_client = WebClient(token=os.environ["SLACK_TOKEN"])
-
-        # os.environ is used instead of os.getenv to raise an exception
+        # raw vertices of the closed roi rings used by point_in_rois,
+        # rows are padded with NaN up to the longest ring
+        rings = [
+            np.asarray(roi.exterior.coords, dtype=np.float64) for roi in self._rois
+        ]
+        max_len = max((len(ring) for ring in rings), default=0)
+        self._roi_xs = np.full((len(rings), max_len), np.nan, dtype=np.float64)
+        self._roi_ys = np.full((len(rings), max_len), np.nan, dtype=np.float64)
+        self._roi_len = np.zeros(len(rings), dtype=np.int32)
+        for index, ring in enumerate(rings):
+            self._roi_xs[index, : len(ring)] = ring[:, 0]
+            self._roi_ys[index, : len(ring)] = ring[:, 1]
+            self._roi_len[index] = len(ring) - 1
+
+        # (minx, miny, maxx, maxy) of every roi for early rejection
+        self._roi_bbox = np.array(
+            [roi.bounds for roi in self._rois], dtype=np.float64
+        ).reshape(-1, 4)
+
+        self.__slack_client = _SLACK_CLIENT
+        self._notify_enabled: bool = self.__slack_client is not None
+
+        # an exception is raised if the channel is missing
         #
         # if __slack_token is present then we need __slack_channel
         # to be present otherwise the program will fail at notify.
         # So this allows the program to fail during initialization instead.
-        self.__slack_channel = os.environ["SLACK_CHANNEL"]
+        if _SLACK_CHANNEL is None:
+            raise KeyError("SLACK_CHANNEL")
+        self.__slack_channel = _SLACK_CHANNEL
+
+        # notifications are posted by a background worker so the event
+        # loop never blocks on the slack api. queued items are
+        # (timestamp, rule_name, cam_name) tuples.
+        self._notify_q: queue.Queue = queue.Queue()
+        if self.__slack_client is not None:
+            threading.Thread(target=self.__notify_worker, daemon=True).start()
 
     def reset_objects(self) -> None:
         """This method is required to reset the objects in all the region of interests.
 
         It is done to so previous frames objects do not interfer with the new frame.
         """
-        for index in range(len(self._objects_in_rois)):
-            self._objects_in_rois[index] = {
-                "car": False,
-                "person": False,
-                "truck": False,
-            }
-
-    def calculate_coords(
-        self,
-        left: float,
-        top: float,
-        width: float,
-        height: float,
-        frame_width: int,
-        frame_height: int,
-    ) -> List[Tuple[float, float]]:
-        """This method is used to convert fractional values to actual values"""
-        return [
-            (
-                # top-left
-                left * frame_width,
-                top * frame_height,
-            ),
-            (
-                # top-right
-                (left + width) * frame_width,
-                top * frame_height,
-            ),
-            (
-                # bottom-right
-                (left + width) * frame_width,
-                (top + height) * frame_height,
-            ),
-            (
-                # bottom-left
-                left * frame_width,
-                (top + height) * frame_height,
-            ),
-        ]
+        self._objects_in_rois.fill(0)
 
     def should_notify(self, current_frame: int) -> bool:
         """This method is responsible to tell if new notification is necessary"""
@@ -110,27 +133,31 @@ class RuleEngine:
         return res
 
     def notify(self, timestamp: int, rule_name: str, cam_name: str) -> None:
+        """This method queues a notification for the background worker"""
         if self.__slack_client == None:
             return
 
+        self._notify_q.put_nowait((timestamp, rule_name, cam_name))
+
+    def __notify_worker(self) -> None:
+        """This method posts the queued notifications until the program exits"""
+        while True:
+            timestamp, rule_name, cam_name = self._notify_q.get()
+            try:
+                self.__post_message(timestamp, rule_name, cam_name)
+            except Exception:
+                # no error may stop the worker, otherwise the remaining
+                # notifications are never marked done and the queue can
+                # never be drained
+                logger.exception("failed to send notification")
+            finally:
+                self._notify_q.task_done()
+
+    def __post_message(self, timestamp: int, rule_name: str, cam_name: str) -> None:
         # for better human readable time
-        seconds = timestamp / 1e9
-
-        seconds = seconds % (24 * 3600)
-        hour = seconds // 3600
-        seconds %= 3600
-        minutes = seconds // 60
-        seconds %= 60
-
-        readable_time = list()
-        if hour > 0:
-            readable_time.append(f"{int(hour)} hours ")
-        if minutes > 0:
-            readable_time.append(f"{int(minutes)} minutes ")
-        if seconds > 0:
-            readable_time.append(f"{int(seconds)} seconds ")
-
-        time_str: str = "".join(readable_time)
+        hours, seconds = divmod(int(timestamp // 1_000_000_000) % (24 * 3600), 3600)
+        minutes, seconds = divmod(seconds, 60)
+        time_str: str = f"{hours}h {minutes}m {seconds}s "
 
         try:
             self.__slack_client.chat_postMessage(
@@ -176,34 +203,70 @@ class CAP(RuleEngine):
 
     def execute(
         self,
-        object: Polygon,
-        obj_class: str,
+        cx: np.ndarray,
+        cy: np.ndarray,
+        classes: np.ndarray,
+        frame_num: int,
+        cam_name: str,
+        timestamp: int,
+    ) -> np.ndarray:
+        """Responsible to execute the CAP rule for all the detections of a frame.
+
+        Returns the index of the region of interest where the rule states
+        positive for each detection else -1.
+        """
+
+        indexes = batch_point_in_rois(
+            cx, cy, self._roi_xs, self._roi_ys, self._roi_len, self._roi_bbox
+        )
+        alerts = np.full(indexes.shape[0], -1, dtype=np.int32)
+
+        for detection, index in enumerate(indexes):
+            if index == -1:
+                continue
+
+            self._objects_in_rois[index, classes[detection]] = 1
+
+            # rule checking (column 0 is car and column 1 is person)
+            if self._objects_in_rois[index, 0] & self._objects_in_rois[index, 1]:
+                self._count += 1
+                if self.should_notify(frame_num):
+                    self.notify(
+                        timestamp=timestamp,
+                        cam_name=cam_name,
+                        rule_name=self.rule_name,
+                    )
+                alerts[detection] = index
+
+        return alerts
+
+    def _execute_render_only(
+        self,
+        cx: np.ndarray,
+        cy: np.ndarray,
+        classes: np.ndarray,
         frame_num: int,
         cam_name: str,
         timestamp: int,
-    ) -> int:
-        """Responsible to execute the CAP rule"""
-
-        for index, roi in enumerate(self._rois):
-            if roi.intersects(object.centroid):
-                self._objects_in_rois[index][obj_class] = True
-
-                # rule checking
-                if (
-                    self._objects_in_rois[index]["car"]
-                    and self._objects_in_rois[index]["person"]
-                ):
-                    self._count += 1
-                    if self.should_notify(frame_num):
-                        self.notify(
-                            timestamp=timestamp,
-                            cam_name=cam_name,
-                            rule_name=self.rule_name,
-                        )
-                    return index
-                break
-
-        return -1
+    ) -> np.ndarray:
+        """Specialization of execute for when notifications are disabled.
+
+        Only the rois where the rule states positive are of interest, so
+        every detection inside such a roi gets its index else -1. The
+        event counter and notifications are skipped.
+        """
+
+        indexes = batch_point_in_rois(
+            cx, cy, self._roi_xs, self._roi_ys, self._roi_len, self._roi_bbox
+        )
+        inside = indexes != -1
+        self._objects_in_rois[indexes[inside], classes[inside]] = 1
+
+        # rule checking (column 0 is car and column 1 is person)
+        positive = self._objects_in_rois[:, 0] & self._objects_in_rois[:, 1]
+        alerts = np.full_like(indexes, -1)
+        alerts[inside] = np.where(positive[indexes[inside]] == 1, indexes[inside], -1)
+        return alerts
 
 
 class Render(CAP):
@@ -220,7 +283,7 @@ class Render(CAP):
     def __init__(
         self,
         rois: List[List[Tuple[int, int]]],
-        frames: List[Dict[str, Any]],
+        frames: Iterable[Dict[str, Any]],
         width: int,
         height: int,
         cam_name: str,
@@ -232,90 +295,197 @@ class Render(CAP):
             os.mkdir("out")
 
         # initialize video
-        self.video = cv2.VideoWriter(
-            "out/output.mp4",
-            cv2.VideoWriter_fourcc(*"mp4v"),
-            5,
-            (width, height),
-        )
+        #
+        # hardware (NVENC) encoding is used when opencv is built with cuda
+        # and a gpu is present, frames are then uploaded to __gpu_frame
+        # before encoding. Otherwise fallback to software mp4v encoding.
+        self.__gpu_frame: Optional[Any] = None
+        try:
+            self.video = cv2.cudacodec.createVideoWriter(
+                "out/output.mp4",
+                (width, height),
+                cv2.cudacodec.Codec_H264,
+                5.0,
+                cv2.cudacodec.ColorFormat_BGR,
+            )
+            self.__gpu_frame = cv2.cuda_GpuMat()
+        except (AttributeError, cv2.error):
+            self.video = cv2.VideoWriter(
+                "out/output.mp4",
+                cv2.VideoWriter_fourcc(*"mp4v"),
+                5,
+                (width, height),
+            )
 
         self.frames = frames
         self.cam_name = cam_name
 
-    def __add_polygon(self, img, polygon, obj_class) -> None:
-        """This function is used to add polygon to the provided image (np.array)"""
-        vertices = np.array(polygon.exterior.coords, np.int32)
-        cv2.polylines(img, [vertices], True, self.__colors[obj_class], 2)
-
-    def __add_dot(self, img, dot, obj_class) -> None:
-        """This function is used to add dot to the provided image (np.array)"""
-        vertices = np.array(dot.coords, np.int32)
-        cv2.circle(
-            img,
-            vertices[0],
-            radius=3,
-            color=self.__colors[obj_class],
-            thickness=-1,
+        # the rule is only fully executed when notifications can be sent,
+        # otherwise it is only needed to color the rois
+        self._execute = (
+            self.execute if self._notify_enabled else self._execute_render_only
+        )
+
+        # two frame buffers are reused by every frame so that one frame can
+        # be drawn while the other one is being encoded. Only the region last
+        # drawn on a buffer, stored as (x0, y0, x1, y1), is cleared.
+        #
+        # Note: rois and the border are drawn at the same place every frame
+        #       so they are simply overwritten and never need to be cleared
+        self._images: List[np.ndarray] = [
+            np.zeros((height, width, 3), dtype=np.uint8) for _ in range(2)
+        ]
+        self._dirty: List[Tuple[int, int, int, int]] = [(0, 0, 0, 0)] * 2
+
+        # indexes of the buffers that are free to draw on and of the buffers
+        # waiting to be encoded (None stops the encoder)
+        self._free_q: queue.Queue = queue.Queue()
+        self._encode_q: queue.Queue = queue.Queue(maxsize=2)
+
+        # exception raised by the encoder, re-raised by render so that a
+        # failed encode is reported instead of blocking on _free_q forever
+        self._encode_error: Optional[Exception] = None
+        for buffer in range(len(self._images)):
+            self._free_q.put(buffer)
+
+        # (detections, 4) buffer holding the x0, y0, x1, y1 pixel corners of
+        # the detections of the current frame, grown only when a frame has
+        # more detections than any frame before it
+        self._boxes = np.empty((0, 4), dtype=np.int32)
+
+        # rois and the border never change so their vertices are only
+        # converted once (draw_polygon closes the ring by itself)
+        self._roi_vertices: List[np.ndarray] = [
+            np.array(roi.exterior.coords[:-1], np.int32) for roi in self._rois
+        ]
+        self._border_vertices: np.ndarray = np.array(
+            [[0, 0], [width, 0], [width, height], [0, height]], dtype=np.int32
         )
 
+    def __write(self, image: np.ndarray) -> None:
+        """This function is used to encode the provided image (np.array)"""
+        if self.__gpu_frame is None:
+            self.video.write(image)
+            return
+
+        self.__gpu_frame.upload(image)
+        self.video.write(self.__gpu_frame)
+
+    def __encode_worker(self) -> None:
+        """This function encodes the drawn buffers and hands them back"""
+        while True:
+            buffer: Optional[int] = self._encode_q.get()
+            if buffer is None:
+                return
+
+            try:
+                self.__write(self._images[buffer])
+            except Exception as e:
+                # hand the buffer back so that render wakes up and re-raises
+                self._encode_error = e
+                self._free_q.put(buffer)
+                return
+
+            self._free_q.put(buffer)
+
+    def __raise_encode_error(self) -> None:
+        """This function re-raises the exception of the encoder if any"""
+        if self._encode_error is not None:
+            raise self._encode_error
+
     def render(self):
         """Handles the main event loop and renders video"""
 
+        encoder = threading.Thread(target=self.__encode_worker, daemon=True)
+        encoder.start()
+
+        # alerts[index] is True if the rule states positive for the roi at
+        # index, the extra last slot absorbs the -1 returned for no roi
+        alerts = np.zeros(len(self._rois) + 1, dtype=bool)
+
         for frame in self.frames:
-            alerts: Set[int] = set()
-            image = np.zeros((height, width, 3), dtype=np.uint8)
+            alerts.fill(False)
+            buffer: int = self._free_q.get()
+            self.__raise_encode_error()
+            image = self._images[buffer]
+            clear_image(image, *self._dirty[buffer])
+
+            # stack the detections of the frame into contiguous arrays
+            detections: List[Dict[str, Any]] = frame["detections"]
+            bboxes = [detection["bbox"] for detection in detections]
+            lefts = np.ascontiguousarray(
+                [bbox["left"] for bbox in bboxes], dtype=np.float64
+            )
+            tops = np.ascontiguousarray(
+                [bbox["top"] for bbox in bboxes], dtype=np.float64
+            )
+            widths = np.ascontiguousarray(
+                [bbox["width"] for bbox in bboxes], dtype=np.float64
+            )
+            heights = np.ascontiguousarray(
+                [bbox["height"] for bbox in bboxes], dtype=np.float64
+            )
+            classes = np.array(
+                [self._class_ids[detection["class"]] for detection in detections],
+                dtype=np.int8,
+            )
 
-            # go through each detection in the frame
-            # and add it to the frame image
-            for detection in frame["detections"]:
-                obj_class: str = detection.get("class")
-                object = Polygon(
-                    self.calculate_coords(
-                        **detection["bbox"],
-                        frame_width=frame["frame_width"],
-                        frame_height=frame["frame_height"],
-                    )
-                )
+            # actual centroids and pixel corners (truncated to int32)
+            if len(detections) > self._boxes.shape[0]:
+                self._boxes = np.empty((len(detections), 4), dtype=np.int32)
+            boxes = self._boxes[: len(detections)]
+            cx = np.empty(len(detections), dtype=np.float64)
+            cy = np.empty(len(detections), dtype=np.float64)
+            scale_bboxes(
+                lefts,
+                tops,
+                widths,
+                heights,
+                frame["frame_width"],
+                frame["frame_height"],
+                cx,
+                cy,
+                boxes,
+            )
 
-                # event detection
-                # self.execute returns the index of region of
-                # interest where the rule states positive else returns -1
-                alerts.add(
-                    self.execute(
-                        object=object,
-                        obj_class=obj_class,
-                        frame_num=frame["frame_num"],
-                        timestamp=frame["timestamp"],
-                        cam_name=self.cam_name,
-                    )
+            # event detection
+            # self._execute returns the index of region of interest
+            # where the rule states positive else -1 for each detection
+            alerts[
+                self._execute(
+                    cx=cx,
+                    cy=cy,
+                    classes=classes,
+                    frame_num=frame["frame_num"],
+                    timestamp=frame["timestamp"],
+                    cam_name=self.cam_name,
                 )
+            ] = True
+
+            # go through each detection in the frame
+            # and add it to the frame image
+            for i, detection in enumerate(detections):
+                color = self.__colors[detection["class"]]
 
                 # render objects
-                self.__add_polygon(image, object, detection["class"])
-                self.__add_dot(image, object.centroid, detection["class"])
+                x0, y0, x1, y1 = boxes[i]
+                draw_bbox_edges(image, x0, y0, x1, y1, color)
+                draw_dot(image, int(cx[i]), int(cy[i]), color)
 
             # draw region of interests to the image
-            indicator: bool = False
-            for index, roi in enumerate(self._rois):
-                color: str = "other"
-                if index in alerts:
-                    indicator = True
-                    color = "alert"
-
-                self.__add_polygon(image, roi, color)
+            for index, vertices in enumerate(self._roi_vertices):
+                color_name: str = "alert" if alerts[index] else "other"
+                draw_polygon(image, vertices, self.__colors[color_name])
 
             # add border
-            color: str = "alert" if indicator else "other"
-            self.__add_polygon(
-                image,
-                Polygon([(0, 0), (width, 0), (width, height), (0, height)]),
-                color,
-            )
+            color_name = "alert" if alerts[:-1].any() else "other"
+            draw_polygon(image, self._border_vertices, self.__colors[color_name])
 
             # draw frame number
+            text: str = f"frame: {frame['frame_num']}"
             cv2.putText(
                 image,
-                f"frame: {frame['frame_num']}",
+                text,
                 (50, 50),
                 cv2.FONT_HERSHEY_SIMPLEX,
                 1,
@@ -323,13 +493,35 @@ class Render(CAP):
                 2,
                 cv2.LINE_AA,
             )
-            self.video.write(image)
+
+            # region to be cleared before drawing on this buffer again
+            (text_width, text_height), baseline = cv2.getTextSize(
+                text, cv2.FONT_HERSHEY_SIMPLEX, 1, 2
+            )
+            dirty = (48, 48 - text_height, 52 + text_width, 52 + baseline)
+            if len(detections) > 0:
+                # line stamps reach 1px around the bbox edges
+                dirty = (
+                    min(dirty[0], int(boxes[:, 0].min()) - 1),
+                    min(dirty[1], int(boxes[:, 1].min()) - 1),
+                    max(dirty[2], int(boxes[:, 2].max()) + 2),
+                    max(dirty[3], int(boxes[:, 3].max()) + 2),
+                )
+            self._dirty[buffer] = dirty
+            self._encode_q.put(buffer)
 
             # reset event detection for next frame
             self.reset_objects()
 
+        # wait for the pending frames to be encoded
+        self._encode_q.put(None)
+        encoder.join()
+        self.__raise_encode_error()
         self.video.release()
 
+        # wait for the pending notifications to be sent
+        self._notify_q.join()
+
 
 if __name__ == "__main__":
     cam_name: str
@@ -337,9 +529,9 @@ if __name__ == "__main__":
     height: int = 1080
 
     # parse frames
-    frames: List[Dict[str, Any]] = list()
-    with open("annotations.json", "r") as f:
-        content = json.loads(f.read())
+    frames: Iterable[Dict[str, Any]]
+    with open("annotations.json", "rb") as f:
+        content = orjson.loads(f.read())
         cam_name = content["cam_name"]
         frames = content["frames"]
 